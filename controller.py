@@ -0,0 +1,441 @@
+import os
+import sys
+import uuid
+import fcntl
+import time
+import threading
+import signal
+import socketserver
+from gpio import GPIO
+from ecobee import Ecobee
+from configuration import config
+from deadline import Deadline, DeadlineExceeded
+from controllerClient import (SOCKET_PATH, COMMAND_DEADLINE_SEC,
+                              encodeMessage, decodeMessage)
+
+if 'Environment' not in config.sections():
+    raise Exception("Cannot find config data. Did you setup config.ini?")
+
+TEMP_CHECK_DELAY_SEC = 180
+TEMP_DIFF = 2
+
+# End-to-end budget for one checkTemps cycle, and the share of it the read
+# stage (fetch, token refresh and replay) may use before the write stage
+CYCLE_DEADLINE_SEC = 60
+READ_STAGE_SEC = 30
+
+# The loop heartbeats every second; a heartbeat older than this means the
+# loop is stalled even allowing for a full-length cycle
+WATCHDOG_INTERVAL_SEC = 10
+WATCHDOG_STALL_SEC = CYCLE_DEADLINE_SEC + 30
+
+# Consecutive failed or aborted cycles after which the fireplace is turned
+# off, as the loop no longer has a temperature to control it by
+MAX_FAILED_CYCLES = 3
+
+
+def withCommandDeadline(func):
+    """
+    Wraps a socket command so each call gets a fresh deadline that ends
+    before the client stops waiting for the reply.
+    """
+    return lambda **args: func(deadline=Deadline(COMMAND_DEADLINE_SEC),
+                               **args)
+
+
+class Controller():
+    """
+    Sole owner of the GPIO pins, the Ecobee client and the scheduled event
+    loop. Web workers talk to it through ControllerServer instead of holding
+    any of this state themselves.
+    """
+    gpio: GPIO = None
+    ecobee: Ecobee = None
+    taskThread: threading.Thread = None
+    watchdogThread: threading.Thread = None
+    lock: threading.RLock = None
+    # Guards the counters below, which threads outside the lock also update
+    counterLock: threading.Lock = None
+
+    # Flags to control the scheduled task
+    eventLoopActive = False
+    forceRefresh = False
+
+    # Bumped whenever a new loop thread starts, so a stalled thread that
+    # eventually wakes up knows it has been replaced
+    loopGeneration = 0
+    lastHeartbeat: float = None
+
+    # Bumped whenever anything shown by getStatus other than the Ecobee
+    # snapshot changes, so rendered pages can be cached against it. Both
+    # this and the snapshot revisions restart with the daemon, so versions
+    # also carry an id unique to this daemon instance.
+    stateVersion = 0
+    instanceId: str = None
+
+    # Cycle timing, reported through getStatus
+    lastCycleSec: float = None
+    cycleOverruns = 0
+    failedCycles = 0
+    watchdogRestarts = 0
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.counterLock = threading.Lock()
+        self.instanceId = uuid.uuid4().hex
+        self.gpio = GPIO()
+        self.ecobee = Ecobee()
+        self.gpio.setButtonCallback(self.buttonCallback)
+        self.watchdogThread = threading.Thread(target=self.watchdog)
+        self.watchdogThread.daemon = True
+        self.watchdogThread.start()
+
+    def bumpStateVersion(self):
+        with self.counterLock:
+            self.stateVersion += 1
+
+    def acquireLock(self, deadline: Deadline = None):
+        """
+        Takes the controller lock, waiting no longer than the deadline allows
+        when one is given.
+        """
+        if deadline is None:
+            self.lock.acquire()
+        elif not self.lock.acquire(timeout=deadline.timeout()):
+            raise DeadlineExceeded("Timed out waiting for controller lock")
+
+    def startFireplace(self, deadline: Deadline = None):
+        self.acquireLock(deadline)
+        try:
+            if not self.gpio.isFireplaceOn():
+                self.gpio.setFireplaceOn()
+            if not self.ecobee.fanHoldActive:
+                self.ecobee.setFanHold(deadline)
+        finally:
+            # The GPIO may have changed even if the Ecobee write failed
+            self.bumpStateVersion()
+            self.lock.release()
+
+    def stopFireplace(self, deadline: Deadline = None):
+        # Switch off straight away rather than waiting behind an in-flight
+        # Ecobee call, then again under the lock in case a cycle that was
+        # holding it has just switched back on
+        self.gpio.setFireplaceOff()
+        self.bumpStateVersion()
+        self.acquireLock(deadline)
+        try:
+            if self.gpio.isFireplaceOn():
+                self.gpio.setFireplaceOff()
+            if self.ecobee.fanHoldActive:
+                self.ecobee.resumeProgram(deadline)
+        finally:
+            self.bumpStateVersion()
+            self.lock.release()
+
+    def checkTemps(self, generation: int):
+        deadline = Deadline(CYCLE_DEADLINE_SEC)
+        # Read without the lock so stop requests never wait on the fetch
+        tempDiff = self.ecobee.getTempDifferential(
+            deadline.stage(READ_STAGE_SEC))
+
+        # A stalled cycle may still hold the lock, so never wait past the
+        # deadline for it
+        self.acquireLock(deadline)
+        try:
+            # Replaced by the watchdog while fetching, don't act on outputs
+            if generation != self.loopGeneration:
+                return
+
+            print("tempDiff: {}".format(tempDiff))
+            print("fireplace.isOn(): {}".format(self.gpio.isFireplaceOn()))
+            print("fireplace.isOff(): {}".format(self.gpio.isFireplaceOff()))
+            print("tempDiff > {}: {}".format(TEMP_DIFF, tempDiff > TEMP_DIFF))
+            print("tempDiff < -{}: {}".format(TEMP_DIFF,
+                                              tempDiff < -TEMP_DIFF))
+
+            # Current temperature is greater than desired
+            if self.eventLoopActive and (tempDiff > TEMP_DIFF):
+                self.stopFireplace(deadline)
+
+            # Current temperature is less than desired
+            if self.eventLoopActive and (tempDiff < -TEMP_DIFF):
+                self.startFireplace(deadline)
+        finally:
+            self.lock.release()
+
+    def runCycle(self, generation: int):
+        cycleStart = time.monotonic()
+        failed = False
+        aborted = False
+        try:
+            self.checkTemps(generation)
+        except DeadlineExceeded as e:
+            print("Cycle deadline exceeded: {}".format(e))
+            failed = aborted = True
+        except Exception as e:
+            # Keep the loop alive; the next cycle retries at the usual pace
+            print("Cycle failed: {}".format(repr(e)))
+            failed = True
+        self.lastCycleSec = time.monotonic() - cycleStart
+
+        if aborted or self.lastCycleSec > CYCLE_DEADLINE_SEC:
+            with self.counterLock:
+                self.cycleOverruns += 1
+            print("Cycle {} its {}s deadline after {:.1f}s ({} total)"
+                  .format("aborted by" if aborted else "overran",
+                          CYCLE_DEADLINE_SEC, self.lastCycleSec,
+                          self.cycleOverruns))
+
+        with self.counterLock:
+            self.failedCycles = self.failedCycles + 1 if failed else 0
+        if (self.failedCycles >= MAX_FAILED_CYCLES and
+                self.gpio.isFireplaceOn()):
+            print("{} consecutive cycles failed, turning fireplace off"
+                  .format(self.failedCycles))
+            self.gpio.setFireplaceOff()
+        self.bumpStateVersion()
+
+    def eventLoop(self, generation: int):
+        seconds = 0
+        while self.eventLoopActive and generation == self.loopGeneration:
+            self.lastHeartbeat = time.monotonic()
+            if (self.forceRefresh or seconds % TEMP_CHECK_DELAY_SEC == 0):
+                self.runCycle(generation)
+                seconds = 0
+                self.forceRefresh = False
+            seconds += 1
+            time.sleep(1)
+        print("Thread ended")
+
+    def startLoop(self):
+        self.loopGeneration += 1
+        self.lastHeartbeat = time.monotonic()
+        self.taskThread = threading.Thread(target=self.eventLoop,
+                                           args=(self.loopGeneration,))
+        self.taskThread.daemon = True
+        self.taskThread.start()
+
+    def getLoopProblem(self):
+        if self.taskThread is None or not self.taskThread.is_alive():
+            return "died"
+        if (self.lastHeartbeat is not None and
+                time.monotonic() - self.lastHeartbeat > WATCHDOG_STALL_SEC):
+            return "stalled"
+        return None
+
+    def watchdog(self):
+        """
+        Restarts the event loop if it has died or stopped heartbeating,
+        turning the fireplace off first. The switch-off doesn't wait for the
+        lock; the restart does, but only briefly, and is retried on the next
+        check if a write is still holding it.
+        """
+        while True:
+            time.sleep(WATCHDOG_INTERVAL_SEC)
+            if not self.eventLoopActive:
+                continue
+
+            problem = self.getLoopProblem()
+            if problem is None:
+                continue
+
+            print("Watchdog: event loop {}, turning fireplace off and"
+                  " restarting".format(problem))
+            self.gpio.setFireplaceOff()
+            self.bumpStateVersion()
+
+            if not self.lock.acquire(timeout=WATCHDOG_INTERVAL_SEC):
+                print("Watchdog: controller lock busy, will retry restart")
+                continue
+            try:
+                # startThread or stopThread may have run in the meantime
+                if self.eventLoopActive and self.getLoopProblem() is not None:
+                    with self.counterLock:
+                        self.watchdogRestarts += 1
+                    self.startLoop()
+            finally:
+                self.lock.release()
+            self.bumpStateVersion()
+
+    def startThread(self, deadline: Deadline = None):
+        self.acquireLock(deadline)
+        try:
+            print("Starting thread")
+            if not self.eventLoopActive:
+                self.eventLoopActive = True
+            if not self.gpio.isIndicatorOn():
+                self.gpio.setIndicatorOn()
+            self.bumpStateVersion()
+            if self.taskThread is None or not self.taskThread.is_alive():
+                self.startLoop()
+        finally:
+            self.lock.release()
+
+    # Doesn't take the lock, so stopping never waits on an Ecobee call
+    def stopThread(self):
+        print("Stopping thread")
+        if self.eventLoopActive:
+            self.eventLoopActive = False
+        if self.gpio.isIndicatorOn():
+            self.gpio.setIndicatorOff()
+        self.bumpStateVersion()
+
+    def stopAll(self, deadline: Deadline = None):
+        self.stopThread()
+        self.stopFireplace(deadline)
+
+    # Toggle event loop whenever button is pressed. Discard arguments
+    def buttonCallback(self, *_):
+        if self.eventLoopActive:
+            self.stopAll()
+        else:
+            self.startThread()
+
+    def getStatus(self, deadline: Deadline = None):
+        summaryData = self.ecobee.getSummaryData(deadline)
+        return {
+            "eventLoopActive": self.eventLoopActive,
+            "runtimeTemp": summaryData['runtimeTemp'],
+            "desiredHeat": summaryData['desiredHeat'],
+            "sensorList": list(summaryData['sensorList']),
+            "overrideTargetTemp": self.ecobee.overrideTargetTemp,
+            "fireplaceOn": self.gpio.isFireplaceOn(),
+            "fanHoldActive": self.ecobee.fanHoldActive,
+            "lastCycleSec": (round(self.lastCycleSec, 1)
+                             if self.lastCycleSec is not None else None),
+            "cycleOverruns": self.cycleOverruns,
+            "failedCycles": self.failedCycles,
+            "watchdogRestarts": self.watchdogRestarts
+        }
+
+    def getVersion(self, snapshot: str, deadline: Deadline = None):
+        revision = self.ecobee.getSnapshotRevision(snapshot, deadline)
+        # The current temperature page shows no controller state
+        if snapshot == 'currentTemp':
+            return [self.instanceId, revision]
+        return [self.instanceId, revision, self.stateVersion]
+
+    def setOverrideTargetTemp(self, target: int, deadline: Deadline = None):
+        self.acquireLock(deadline)
+        try:
+            self.ecobee.setOverrideTargetTemp(target)
+            self.forceRefresh = True
+            self.bumpStateVersion()
+        finally:
+            self.lock.release()
+
+    def clearOverrideTargetTemp(self, deadline: Deadline = None):
+        self.acquireLock(deadline)
+        try:
+            self.ecobee.clearOverrideTargetTemp()
+            self.forceRefresh = True
+            self.bumpStateVersion()
+        finally:
+            self.lock.release()
+
+    def getCommands(self):
+        return {
+            'status': withCommandDeadline(self.getStatus),
+            'version': withCommandDeadline(self.getVersion),
+            'startFireplace': withCommandDeadline(self.startFireplace),
+            'stopFireplace': withCommandDeadline(self.stopFireplace),
+            'startThread': withCommandDeadline(self.startThread),
+            'stopThread': self.stopThread,
+            'stopAll': withCommandDeadline(self.stopAll),
+            'info': withCommandDeadline(self.ecobee.getInfo),
+            'sensors': withCommandDeadline(self.ecobee.getSensors),
+            'events': withCommandDeadline(self.ecobee.getEvents),
+            'currentTemp': withCommandDeadline(self.ecobee.getCurrentTemp),
+            'authorize': self.ecobee.authorize,
+            'completeAuthorization': self.ecobee.completeAuthorization,
+            'getOverride': lambda: self.ecobee.overrideTargetTemp,
+            'setOverride': withCommandDeadline(self.setOverrideTargetTemp),
+            'clearOverride': withCommandDeadline(
+                self.clearOverrideTargetTemp)
+        }
+
+    def cleanup(self):
+        self.gpio.cleanup()
+
+
+class ControllerRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single newline-delimited JSON command of the form
+    {"command": ..., "args": {...}} and replies with either
+    {"result": ...} or {"error": ...}.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            message = decodeMessage(line)
+            command = self.server.commands[message['command']]
+            response = {'result': command(**message.get('args', {}))}
+        except Exception as e:
+            print("Controller command failed: {}".format(repr(e)))
+            response = {'error': str(e) or repr(e)}
+        self.wfile.write(encodeMessage(response))
+
+
+def acquireInstanceLock(socketPath: str = SOCKET_PATH):
+    """
+    Takes an exclusive lock next to the socket so only one daemon at a time
+    owns the GPIO pins. Must be called before creating the Controller; the
+    returned file has to stay open for the life of the process.
+    """
+    lockFile = open(socketPath + '.lock', 'w')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockFile.close()
+        raise Exception("Another controller is already running on {}"
+                        .format(socketPath))
+    return lockFile
+
+
+class ControllerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    commands: dict = None
+    socketPath: str = None
+    # Identifies the socket file this server created
+    socketInode: int = None
+
+    def __init__(self, controller: Controller, socketPath: str = SOCKET_PATH):
+        self.commands = controller.getCommands()
+        self.socketPath = socketPath
+        # Holding the instance lock, any existing socket is stale
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        super().__init__(socketPath, ControllerRequestHandler)
+        self.socketInode = os.stat(socketPath).st_ino
+
+    def removeSocket(self):
+        """
+        Removes the socket file, unless it has since been replaced by one
+        this server didn't create.
+        """
+        try:
+            if os.stat(self.socketPath).st_ino == self.socketInode:
+                os.remove(self.socketPath)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    instanceLock = acquireInstanceLock()
+    controller = Controller()
+    server = ControllerServer(controller)
+
+    def onExit(signal, frame):
+        controller.cleanup()
+        server.server_close()
+        server.removeSocket()
+        sys.exit()
+
+    signal.signal(signal.SIGINT, onExit)
+    signal.signal(signal.SIGTERM, onExit)
+
+    print("Controller listening on {}".format(SOCKET_PATH))
+    server.serve_forever()
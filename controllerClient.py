@@ -0,0 +1,99 @@
+import json
+import socket
+from configuration import config
+
+SOCKET_PATH = config.get('Environment', 'ControllerSocket',
+                         '/tmp/fireplace-controller.sock')
+# Budget the daemon gives each command, including any wait for the
+# controller lock. The client waits a little longer so it always sees the
+# daemon's answer, error or not, rather than giving up first.
+COMMAND_DEADLINE_SEC = 20
+SOCKET_TIMEOUT_SEC = COMMAND_DEADLINE_SEC + 10
+
+
+def encodeMessage(message: dict):
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def decodeMessage(line: bytes):
+    return json.loads(line.decode('utf-8'))
+
+
+class ControllerClient():
+    """
+    Stateless handle to the control daemon (see controller.py). Each call
+    opens a connection to the daemon's local socket, sends one command and
+    waits for its reply, so any number of web workers can share one daemon.
+    """
+    socketPath: str = None
+
+    def __init__(self, socketPath: str = SOCKET_PATH):
+        self.socketPath = socketPath
+
+    def __request__(self, command: str, **args):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SOCKET_TIMEOUT_SEC)
+            sock.connect(self.socketPath)
+            sock.sendall(encodeMessage({'command': command, 'args': args}))
+            with sock.makefile('rb') as file:
+                line = file.readline()
+
+        if not line:
+            raise Exception("No response from controller for {}"
+                            .format(command))
+        response = decodeMessage(line)
+        if 'error' in response:
+            raise Exception(response['error'])
+        return response['result']
+
+    def getStatus(self):
+        return self.__request__('status')
+
+    def getVersion(self, snapshot: str):
+        """
+        Returns an opaque version for the given view ('summary' or
+        'currentTemp') that changes whenever anything it shows may have.
+        """
+        return self.__request__('version', snapshot=snapshot)
+
+    def startFireplace(self):
+        return self.__request__('startFireplace')
+
+    def stopFireplace(self):
+        return self.__request__('stopFireplace')
+
+    def startThread(self):
+        return self.__request__('startThread')
+
+    def stopThread(self):
+        return self.__request__('stopThread')
+
+    def stopAll(self):
+        return self.__request__('stopAll')
+
+    def getInfo(self):
+        return self.__request__('info')
+
+    def getSensors(self):
+        return self.__request__('sensors')
+
+    def getEvents(self):
+        return self.__request__('events')
+
+    def getCurrentTemp(self):
+        return self.__request__('currentTemp')
+
+    def authorize(self):
+        return self.__request__('authorize')
+
+    def completeAuthorization(self):
+        return self.__request__('completeAuthorization')
+
+    def getOverrideTargetTemp(self):
+        return self.__request__('getOverride')
+
+    def setOverrideTargetTemp(self, target: int):
+        return self.__request__('setOverride', target=target)
+
+    def clearOverrideTargetTemp(self):
+        return self.__request__('clearOverride')
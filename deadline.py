@@ -0,0 +1,47 @@
+import time
+
+# Timeout passed to every HTTP request, with or without a deadline. Like any
+# requests timeout it bounds the connect and each socket read, not the total
+# time taken by a response that keeps trickling in.
+REQUEST_TIMEOUT_SEC = 20
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline():
+    """
+    End-to-end time budget for one control cycle. Stages take a share of it
+    with stage(), and each request within a stage asks timeout() for how long
+    it may block on connecting or on any one read. A slow-drip response can
+    still run past the deadline; the next timeout() call then raises, and
+    the controller counts the cycle as an overrun.
+    """
+    expires: float
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def stage(self, seconds: float):
+        """
+        Returns a deadline for a stage of at most the given length that never
+        outlives this one.
+        """
+        stageDeadline = Deadline(seconds)
+        stageDeadline.expires = min(stageDeadline.expires, self.expires)
+        return stageDeadline
+
+    def timeout(self):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline exceeded by {:.1f}s"
+                                   .format(-remaining))
+        return min(remaining, REQUEST_TIMEOUT_SEC)
+
+
+def requestTimeout(deadline: Deadline = None):
+    return REQUEST_TIMEOUT_SEC if deadline is None else deadline.timeout()
@@ -1,7 +1,9 @@
 import requests
 import time
-from typing import Callable, Dict
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
 from ecobeeAuth import EcobeeAuth
+from deadline import Deadline, REQUEST_TIMEOUT_SEC, requestTimeout
 from configuration import config
 
 AUTHORIZE_URL = 'https://api.ecobee.com/authorize'
@@ -11,6 +13,15 @@ THERMOSTAT_URL = 'https://api.ecobee.com/1/thermostat?format=json'
 # Cache life is 3 minutes, per ecobee API limits
 # https://www.ecobee.com/home/developer/api/documentation/v1/operations/get-thermostat-summary.shtml
 CACHE_LIFE = 180
+# Events can change at any time, but the dashboard should not cost an API
+# call per view. Our own writes invalidate this entry immediately.
+EVENTS_CACHE_LIFE = 30
+EVENTS_CACHE_KEY = 'INFO_events'
+SENSORS_CACHE_KEY = 'INFO_sensors'
+RUNTIME_SENSORS_CACHE_KEY = 'INFO_runtime_sensors'
+# Writes remembered for reapplying to fetches that were already in flight.
+# Writes happen a few times an hour, far fewer than this per fetch.
+RECENT_WRITES = 16
 # TODO: This should be a config value
 MONITOR_SENSOR_NAME = 'Home'
 
@@ -29,22 +40,102 @@ def starWatched(name):
     return "*" + name if name == MONITOR_SENSOR_NAME else name
 
 
+def withEquipment(name):
+    def patch(equipmentStatus):
+        running = [x for x in equipmentStatus.split(',') if x]
+        return ','.join(running if name in running else running + [name])
+    return patch
+
+
+def withoutEquipment(name):
+    def patch(equipmentStatus):
+        running = [x for x in equipmentStatus.split(',') if x]
+        # Other running equipment (e.g. heat) keeps the fan going on its own
+        return equipmentStatus if running != [name] else ''
+    return patch
+
+
+# Fields of a cached thermostat snapshot affected by our own writes, as
+# (section, field) -> function of the cached value returning the new value
+FAN_HOLD_FIELDS = {
+    ('runtime', 'desiredFanMode'): lambda _: 'on',
+    ('equipmentStatus',): withEquipment('fan')
+}
+RESUME_PROGRAM_FIELDS = {
+    ('runtime', 'desiredFanMode'): lambda _: 'auto',
+    ('equipmentStatus',): withoutEquipment('fan')
+}
+
+
 class CacheEntry():
     time: float
+    life: float
     value: any
+    # Bumped whenever this key is refetched or patched
+    revision: int
+    # Fields patched locally after a write, awaiting a real fetch, as
+    # path -> (value, write sequence number)
+    asserted: Dict[Tuple[str, ...], Tuple[any, int]]
 
-    def __init__(self, value):
+    def __init__(self, value, life=CACHE_LIFE, revision=0):
         self.time = time.time()
+        self.life = life
         self.value = value
+        self.revision = revision
+        self.asserted = {}
 
     def isCurrent(self):
-        return (time.time() - self.time) < CACHE_LIFE
+        return (time.time() - self.time) < self.life
+
+    def assertFields(self, fields: Dict[Tuple[str, ...], Callable],
+                     sequence: int):
+        """
+        Patches the given fields of every thermostat in this snapshot in
+        place for write number sequence. Only sections this snapshot
+        actually selected are touched.
+        """
+        for thermostat in self.value.get('thermostatList', []):
+            for path, patch in fields.items():
+                parent = thermostat
+                for key in path[:-1]:
+                    parent = parent.get(key) if parent is not None else None
+                if parent is None or path[-1] not in parent:
+                    continue
+                parent[path[-1]] = patch(parent[path[-1]])
+                self.asserted[path] = (parent[path[-1]], sequence)
+                self.revision += 1
+
+    def reconcile(self, cacheKey: str, value, fetchSequence: int):
+        """
+        Compares locally asserted fields against a freshly fetched snapshot.
+        Only writes up to fetchSequence, the last one made before the fetch
+        started, can be reflected in it.
+        """
+        for path, (assertedValue, sequence) in self.asserted.items():
+            if sequence > fetchSequence:
+                continue
+            for thermostat in value.get('thermostatList', []):
+                actualValue = thermostat
+                for key in path:
+                    actualValue = (actualValue.get(key)
+                                   if actualValue is not None else None)
+                if actualValue == assertedValue:
+                    print("Cache {}: confirmed {}".format(
+                        cacheKey, '.'.join(path)))
+                else:
+                    print("Cache {}: corrected {} from {} to {}".format(
+                        cacheKey, '.'.join(path), assertedValue,
+                        actualValue))
 
 
 class Ecobee():
     auth: EcobeeAuth = None
     accessToken: str = None
     cache: Dict[str, CacheEntry] = {}
+    # Numbers each successful write, with the fields it patched
+    writeSequence = 0
+    recentWrites: Deque[Tuple[int, Dict[Tuple[str, ...], Callable]]] = \
+        deque(maxlen=RECENT_WRITES)
     overrideTargetTemp = None
     fanHoldActive = False
 
@@ -54,7 +145,7 @@ class Ecobee():
             'grant_type': 'ecobeePin',
             'code': self.auth.authCode,
             'client_id': clientId
-        })
+        }, timeout=REQUEST_TIMEOUT_SEC)
         if requestResponse.status_code != 200:
             print("Unable to request access token. Try reauthorizing at",
                   "/authorize")
@@ -65,13 +156,13 @@ class Ecobee():
         self.auth.refreshToken = jsonResponse['refresh_token']
 
     # This can probably be consolidated with request above
-    def __refreshAccessToken__(self):
+    def __refreshAccessToken__(self, deadline: Deadline = None):
         clientId = config.get('Auth', 'ClientId', None)
         refreshResponse = requests.post(TOKEN_URL, params={
               'grant_type': 'refresh_token',
               'refresh_token': self.auth.refreshToken,
               'client_id': clientId
-        })
+        }, timeout=requestTimeout(deadline))
         jsonResponse = refreshResponse.json()
         self.accessToken = jsonResponse['access_token']
         self.auth.refreshToken = jsonResponse['refresh_token']
@@ -81,27 +172,69 @@ class Ecobee():
             raise Exception("Authorization required, go to /authorize")
         return {'Authorization': 'Bearer {}'.format(self.accessToken)}
 
-    def __withRefresh__(self, func: Callable[..., requests.Response]):
-        result = func()
+    def __withRefresh__(self,
+                        func: Callable[..., requests.Response],
+                        deadline: Deadline = None):
+        """
+        Calls func with a request timeout, refreshing the access token and
+        replaying once if it has expired. With a deadline, the first call,
+        the refresh and the replay each get a timeout from its remaining time
+        and no call starts once it has passed.
+        """
+        result = func(requestTimeout(deadline))
         if not isExpiredTokenResult(result):
             return result
-        self.__refreshAccessToken__()
-        return func()
+        self.__refreshAccessToken__(deadline)
+        return func(requestTimeout(deadline))
 
     def __request__(self,
                     func: Callable[..., requests.Response],
-                    cacheKey: str):
-        if cacheKey in self.cache and self.cache[cacheKey].isCurrent():
-            return self.cache[cacheKey].value
+                    cacheKey: str,
+                    life: float = CACHE_LIFE,
+                    deadline: Deadline = None):
+        """
+        Returns the parsed JSON for cacheKey, fetching it if the cached copy
+        has expired. Cached values may have been patched by __assertCached__.
+        """
+        previous = self.cache.get(cacheKey)
+        if previous is not None and previous.isCurrent():
+            return previous.value
         print("making request")
-        response = self.__withRefresh__(func)
-        self.cache[cacheKey] = CacheEntry(response)
-        return response
+        fetchSequence = self.writeSequence
+        value = self.__withRefresh__(func, deadline).json()
+
+        # Re-read, as a write may have patched the entry while fetching
+        previous = self.cache.get(cacheKey)
+        revision = 0
+        if previous is not None:
+            previous.reconcile(cacheKey, value, fetchSequence)
+            revision = previous.revision + 1
+        entry = CacheEntry(value, life, revision)
+        # The fetched value predates any write made since it started, so
+        # apply those again rather than losing them until the next fetch
+        for sequence, fields in list(self.recentWrites):
+            if sequence > fetchSequence:
+                entry.assertFields(fields, sequence)
+        self.cache[cacheKey] = entry
+        return entry.value
+
+    def __assertCached__(self, fields: Dict[Tuple[str, ...], Callable]):
+        """
+        Write-through after a successful thermostat write: patch every cached
+        snapshot so reads reflect the write without another fetch, and drop
+        the events cache since a write adds or removes hold events.
+        """
+        self.writeSequence += 1
+        self.recentWrites.append((self.writeSequence, fields))
+        for entry in list(self.cache.values()):
+            entry.assertFields(fields, self.writeSequence)
+        self.cache.pop(EVENTS_CACHE_KEY, None)
 
     def __getInfoRuntime__(self):
         return self.__request__(
-            lambda:
+            lambda timeout:
             requests.get(THERMOSTAT_URL,
+                         timeout=timeout,
                          headers=self.__getAuthHeaders__(),
                          params={
                             'body': '''
@@ -111,10 +244,11 @@ class Ecobee():
                          ),
             'INFO_runtime')
 
-    def __getInfoSensors__(self):
+    def __getInfoSensors__(self, deadline: Deadline = None):
         return self.__request__(
-            lambda:
+            lambda timeout:
             requests.get(THERMOSTAT_URL,
+                         timeout=timeout,
                          headers=self.__getAuthHeaders__(),
                          params={
                             'body': '''
@@ -122,12 +256,14 @@ class Ecobee():
                             "selectionMatch":"","includeSensors":true}}
                             '''}
                          ),
-            'INFO_sensors')
+            SENSORS_CACHE_KEY,
+            deadline=deadline)
 
-    def __getInfoRuntimeSensors__(self):
+    def __getInfoRuntimeSensors__(self, deadline: Deadline = None):
         return self.__request__(
-            lambda:
+            lambda timeout:
             requests.get(THERMOSTAT_URL,
+                         timeout=timeout,
                          headers=self.__getAuthHeaders__(),
                          params={
                             'body': '''
@@ -135,12 +271,14 @@ class Ecobee():
                             "selectionMatch":"","includeRuntime":true,"includeSensors":true}}
                             '''}
                          ),
-            'INFO_runtime_sensors')
+            RUNTIME_SENSORS_CACHE_KEY,
+            deadline=deadline)
 
-    def __getInfoRuntimeSettingsStatus__(self):
+    def __getInfoRuntimeSettingsStatus__(self, deadline: Deadline = None):
         return self.__request__(
-            lambda:
+            lambda timeout:
             requests.get(THERMOSTAT_URL,
+                         timeout=timeout,
                          headers=self.__getAuthHeaders__(),
                          params={
                             'body': '''
@@ -149,7 +287,8 @@ class Ecobee():
                             "includeSettings":true,"includeEquipmentStatus":true}}
                             '''}
                          ),
-            'INFO_runtime_settings_status')
+            'INFO_runtime_settings_status',
+            deadline=deadline)
 
     def __init__(self):
         clientId = config.get('Auth', 'ClientId', None)
@@ -177,7 +316,7 @@ class Ecobee():
             'response_type': 'ecobeePin',
             'client_id': clientId,
             'scope': 'smartWrite'
-        })
+        }, timeout=REQUEST_TIMEOUT_SEC)
         if authorizeResponse.status_code != 200:
             print("Failed to request authorization:")
             print(authorizeResponse)
@@ -189,40 +328,61 @@ class Ecobee():
         self.__requestAccessToken__()
         return True if self.accessToken is not None else False
 
-    def getInfo(self):
-        return self.__getInfoRuntimeSettingsStatus__().json()
-
-    def getSensors(self):
-        return self.__getInfoSensors__().json()
-
-    def getEvents(self):
-        # Not cached as events can happen anytime
-        return self.__withRefresh__(
-            lambda: requests.get(THERMOSTAT_URL,
-                                 headers=self.__getAuthHeaders__(),
-                                 params={
-                                    'body': '''
-                                    {"selection":{"selectionType":"registered",
-                                    "selectionMatch":"","includeEvents":true}}
-                                    '''}
-                                 )).json()
-
-    def getCurrentTemp(self):
-        sensors = (self.__getInfoSensors__().json()
+    def getSnapshotRevision(self, snapshot: str,
+                            deadline: Deadline = None):
+        """
+        Returns the revision of the snapshot behind the given view
+        ('summary' or 'currentTemp') after making sure it is current, so
+        anything rendered from it can be keyed on the result.
+        """
+        if snapshot == 'summary':
+            self.__getInfoRuntimeSensors__(deadline)
+            cacheKey = RUNTIME_SENSORS_CACHE_KEY
+        elif snapshot == 'currentTemp':
+            self.__getInfoSensors__(deadline)
+            cacheKey = SENSORS_CACHE_KEY
+        else:
+            raise Exception("Unknown snapshot {}".format(snapshot))
+        return self.cache[cacheKey].revision
+
+    def getInfo(self, deadline: Deadline = None):
+        return self.__getInfoRuntimeSettingsStatus__(deadline)
+
+    def getSensors(self, deadline: Deadline = None):
+        return self.__getInfoSensors__(deadline)
+
+    def getEvents(self, deadline: Deadline = None):
+        # Short cache life as events can happen anytime
+        return self.__request__(
+            lambda timeout: requests.get(THERMOSTAT_URL,
+                                         timeout=timeout,
+                                         headers=self.__getAuthHeaders__(),
+                                         params={
+                                            'body': '''
+                                            {"selection":{"selectionType":"registered",
+                                            "selectionMatch":"","includeEvents":true}}
+                                            '''}
+                                         ),
+            EVENTS_CACHE_KEY,
+            EVENTS_CACHE_LIFE,
+            deadline)
+
+    def getCurrentTemp(self, deadline: Deadline = None):
+        sensors = (self.__getInfoSensors__(deadline)
                    ['thermostatList'][0]
                    ['remoteSensors'])
 
         return int(next(getTemp(sensor) for sensor in sensors
                         if sensor['name'] == MONITOR_SENSOR_NAME))
 
-    def getTempDifferential(self):
+    def getTempDifferential(self, deadline: Deadline = None):
         """
         Returns the difference between current temp and desired heating temp in
         tenths of degrees. Positive numbers indicate the current temperature
         is warmer than desired, negative number indicate that the current
         temperature is lower than desired.
         """
-        infoJson = self.__getInfoRuntimeSensors__().json()
+        infoJson = self.__getInfoRuntimeSensors__(deadline)
         sensors = infoJson['thermostatList'][0]['remoteSensors']
         runtime = infoJson['thermostatList'][0]['runtime']
 
@@ -235,13 +395,14 @@ class Ecobee():
 
         return currentTemp - setTemperature
 
-    def setFanHold(self):
+    def setFanHold(self, deadline: Deadline = None):
         if self.fanHoldActive:
             return
 
-        headers = self.__getAuthHeaders__()
         self.__withRefresh__(
-            lambda: requests.post(THERMOSTAT_URL, headers=headers, json={
+            lambda timeout: requests.post(
+                THERMOSTAT_URL, timeout=timeout,
+                headers=self.__getAuthHeaders__(), json={
                 "selection": {
                     "selectionType": "registered",
                     "selectionMatch": ""
@@ -255,17 +416,20 @@ class Ecobee():
                         }
                     }
                 ]
-            })
+            }),
+            deadline
         ).raise_for_status()
         self.fanHoldActive = True
+        self.__assertCached__(FAN_HOLD_FIELDS)
 
-    def resumeProgram(self):
+    def resumeProgram(self, deadline: Deadline = None):
         if not self.fanHoldActive:
             return
 
-        headers = self.__getAuthHeaders__()
         self.__withRefresh__(
-            lambda: requests.post(THERMOSTAT_URL, headers=headers, json={
+            lambda timeout: requests.post(
+                THERMOSTAT_URL, timeout=timeout,
+                headers=self.__getAuthHeaders__(), json={
                 "selection": {
                     "selectionType": "registered",
                     "selectionMatch": ""
@@ -278,9 +442,11 @@ class Ecobee():
                         }
                     }
                 ]
-            })
+            }),
+            deadline
         ).raise_for_status()
         self.fanHoldActive = False
+        self.__assertCached__(RESUME_PROGRAM_FIELDS)
 
     def setOverrideTargetTemp(self, target: int):
         self.overrideTargetTemp = target
@@ -289,13 +455,13 @@ class Ecobee():
         self.overrideTargetTemp = None
 
     def getDesiredHeat(self):
-        return (self.__getInfoRuntime__().json()
+        return (self.__getInfoRuntime__()
                 ['thermostatList'][0]
                 ['runtime']
                 ['desiredHeat'])
 
-    def getSummaryData(self):
-        infoJson = self.__getInfoRuntimeSensors__().json()
+    def getSummaryData(self, deadline: Deadline = None):
+        infoJson = self.__getInfoRuntimeSensors__(deadline)
 
         runtimeTemp = int(infoJson
                           ['thermostatList'][0]
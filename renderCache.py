@@ -0,0 +1,43 @@
+import gzip
+from typing import Callable, Dict
+from flask import Response, request
+
+
+class RenderedPage():
+    version: tuple
+    body: bytes
+    gzipBody: bytes
+
+    def __init__(self, version: tuple, body: str):
+        self.version = version
+        self.body = body.encode('utf-8')
+        # mtime=0 keeps the compressed body identical across renders
+        self.gzipBody = gzip.compress(self.body, mtime=0)
+
+
+class RenderCache():
+    """
+    Per-worker cache of rendered pages. Each page keeps only its latest
+    render, keyed by the version it was rendered from, so a repeat view of
+    unchanged data costs a lookup instead of parsing and templating.
+    """
+    pages: Dict[str, RenderedPage] = None
+
+    def __init__(self):
+        self.pages = {}
+
+    def respond(self, page: str, version, render: Callable[[], str]):
+        version = tuple(version)
+        rendered = self.pages.get(page)
+        if rendered is None or rendered.version != version:
+            rendered = RenderedPage(version, render())
+            self.pages[page] = rendered
+
+        # Honour q-values, e.g. gzip;q=0 refuses gzip
+        if request.accept_encodings['gzip'] > 0:
+            response = Response(rendered.gzipBody, mimetype='text/html')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(rendered.body, mimetype='text/html')
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response